@@ -12,11 +12,23 @@ This information is saved and fed into the model so the output can be reshaped.
 
 import torch
 from torch import nn
-import numpy as np
+from torch.nn import functional as F
 from general_models import ConvBlock
 from general_models import MaxPlusMinPooling
 from general_models import GlobalMaxPlusMinPooling
-from general_models import kronecker_prod
+
+# Side CUDA streams for the pose branch, one per device. Kept outside the 
+# modules so models stay picklable and deep-copyable.
+_POSE_STREAMS = {}
+
+def _pose_stream(device):
+    """Returns the side stream for the pose branch on device."""
+
+    stream = _POSE_STREAMS.get(device)
+    if stream is None:
+        stream = torch.cuda.Stream(device=device)
+        _POSE_STREAMS[device] = stream
+    return stream
 
 class ActionStart(nn.Module):
     """Part of model below action prediction block in Figure 13.
@@ -59,18 +71,75 @@ class ActionStart(nn.Module):
 
         """
 
-        out_left = self.conv_left1(x)
-        out_middle = self.conv_middle1(x)
-        out_right = self.conv_right1(x)        
-        out = torch.cat((out_left, out_middle, out_right), dim=1)
+        if hasattr(self, 'conv_merged1'): # set by fuse_
+            out = self.conv_merged1(x)
+        else:
+            out_left = self.conv_left1(x)
+            out_middle = self.conv_middle1(x)
+            out_right = self.conv_right1(x)        
+            out = torch.cat((out_left, out_middle, out_right), dim=1)
         out_left2 = self.conv_left2(out)
         out_right2 = self.conv_right2(out)
         out2 = torch.cat((out_left2, out_right2), dim=1)
         out2 = self.maxplusmin(out2)
         return out2
 
+    def fuse_(self):
+        """Merges the three first convs into one (3, 5) conv for inference.
+
+        The (3, 1) and 3 x 3 kernels are zero-padded to (3, 5) and centered, 
+        which with 'same' padding gives the same outputs, and their output 
+        channels are stacked in concatenation order. This runs one conv 
+        instead of three plus a torch.cat, and the original convs are 
+        removed. The ConvBlocks must already be fused, so each is just a 
+        conv followed by a relu.
+
+        Only done for pose recognition: with 3 input channels the padded 
+        kernels add negligible work, while for the 576-channel appearance 
+        input they cost about 36% more multiply-adds.
+
+        Returns:
+            self.
+
+        """
+
+        if self.training:
+            raise RuntimeError('ActionStart can only be fused in eval mode.')
+        if not self.pose_rec or hasattr(self, 'conv_merged1'):
+            return self
+        blocks = (self.conv_left1, self.conv_middle1, self.conv_right1)
+        if any(isinstance(block.batch_norm, nn.BatchNorm2d) for block in blocks):
+            raise RuntimeError('Fuse the ConvBlocks before fusing ActionStart.')
+        n_out = sum(block.conv.out_channels for block in blocks)
+        merged = nn.Conv2d(self.dim, n_out, (3, 5), padding='same').to(
+            device=self.conv_left1.conv.weight.device, 
+            dtype=self.conv_left1.conv.weight.dtype)
+        with torch.no_grad():
+            merged.weight.zero_()
+            start = 0
+            for block in blocks:
+                weight = block.conv.weight
+                end = start + weight.shape[0]
+                kh, kw = weight.shape[-2:]
+                top = (3 - kh) // 2
+                left = (5 - kw) // 2
+                merged.weight[start:end, :, top:top + kh, left:left + kw] = weight
+                merged.bias[start:end] = block.conv.bias
+                start = end
+        self.conv_merged1 = nn.Sequential(
+            merged.to(memory_format=torch.channels_last), nn.ReLU())
+        del self.conv_left1
+        del self.conv_middle1
+        del self.conv_right1
+        return self
+
 class ActionBlock(nn.Module):
     """Action prediction block in Figure 13.
+
+    The convs form a single dependency chain (conv3 consumes 
+    x + conv2(conv1(x))), so the only branch that could overlap is the 
+    action head on the heatmaps. It is too cheap to be worth its own CUDA 
+    stream, so everything runs on the current stream.
     
     Attributes:
         pose_rec: pose_rec: whether to use pose-based recognition. If so,
@@ -95,7 +164,7 @@ class ActionBlock(nn.Module):
         self.conv5 = ConvBlock(N_a, dim, 3, padding='same')
         # Input: N_a x H x W. output: N_a.
         self.global_maxplusmin = GlobalMaxPlusMinPooling()
-        self.softmax = nn.Softmax(0)
+        self.softmax = nn.Softmax(dim=-1)
     
     def forward(self, x, up_shape):    
         """
@@ -113,19 +182,21 @@ class ActionBlock(nn.Module):
     
         """  
 
-        self.upsample = nn.Upsample(size=up_shape, mode='nearest')
-
         out = self.conv2(self.conv1(x))
         out = x + out
         out1 = self.conv3(out)           
         out2 = self.maxplusmin(out1)        
         heatmaps = self.conv4(out2)        
-        out2 = self.upsample(heatmaps)        
+        # Upsample by size rather than scale factor 2, as pooling floors odd 
+        # dims. Keep NHWC so conv5 doesn't need a layout transpose.
+        out2 = F.interpolate(heatmaps, size=up_shape, mode='nearest').contiguous(
+            memory_format=torch.channels_last)
         out2 = self.conv5(out2)        
         out2 = out2 + out1
         out = out + out2
         actions = self.global_maxplusmin(heatmaps)
-        actions = self.softmax(actions.flatten())        
+        # Softmax over the actions of each sample, not across the batch.
+        actions = self.softmax(actions)
         return actions, out
 
 class ActionCombined(nn.Module):
@@ -149,7 +220,8 @@ class ActionCombined(nn.Module):
         self.K = K
         self.B = B
         self.action_start = ActionStart(pose_rec)
-        self.action_blocks = [ActionBlock(pose_rec=pose_rec, N_a=self.N_a) for i in range(K)]        
+        self.action_blocks = nn.ModuleList(
+            [ActionBlock(pose_rec=pose_rec, N_a=self.N_a) for _ in range(K)])
     
     def forward(self, x):
         """
@@ -165,12 +237,24 @@ class ActionCombined(nn.Module):
         """
 
         # Dimensions to upsample to so I can add outputs in the action blocks.
-        up_shape = list(np.array(x.shape[-2:]) // 2) 
+        up_shape = [dim // 2 for dim in x.shape[-2:]]
         # Keep track of previous block output and add to input of next block.        
         out = self.action_start(x)
-        prev_out = 0   
+        prev_out = None
+        # Only allocated per forward, so concurrent forwards don't share it 
+        # and it isn't kept alive between calls.
+        buf = None
         for block in self.action_blocks:      
-            actions, new_out = block(out + prev_out, up_shape=up_shape)
+            if prev_out is None: # first block has no previous output to add
+                block_input = out
+            elif torch.is_grad_enabled():
+                block_input = out + prev_out
+            else:
+                # out= isn't differentiable, so only reuse a buffer without grad.
+                if buf is None:
+                    buf = torch.empty_like(out)
+                block_input = torch.add(out, prev_out, out=buf)
+            actions, new_out = block(block_input, up_shape=up_shape)
             prev_out = out
             out = new_out                                     
         actions = actions.view(self.B, -1)   
@@ -179,6 +263,9 @@ class ActionCombined(nn.Module):
 def appearance_extract(entry_input, prob_maps, B):
     """Extracts localized appearance features to be fed into the action blocks.
 
+    This is a single batched matmul, so it isn't compiled on its own; it is 
+    traced along with the rest of forward by ActionRecognition.compile_forward.
+
     Args:
         entry_input: B x 576 x H x W output from global entry flow, which is
             the multitask stem based on Inception-V4.        
@@ -191,8 +278,14 @@ def appearance_extract(entry_input, prob_maps, B):
 
     """
 
-    out = kronecker_prod(entry_input, prob_maps) # B * T x N_f x N_J x H x W        
-    out = torch.sum(out, dim=(-2, -1)) # B * T x N_f x N_J        
+    # Kronecker product summed over H x W is an inner product over the 
+    # flattened spatial dims, so compute it as one batched matmul.
+    Bf, N_f, H, W = entry_input.shape
+    N_J = prob_maps.shape[1]
+    out = torch.bmm(
+        entry_input.reshape(Bf, N_f, H * W),
+        prob_maps.reshape(Bf, N_J, H * W).transpose(1, 2)
+    ) # B * T x N_f x N_J
     out = out.view(B, out.shape[1], -1, out.shape[2])
     return out
 
@@ -206,20 +299,24 @@ class ActionRecognition(nn.Module):
         N_a: number of actions.
         B: batch size.
         K: number of action recognition blocks.
+        amp_dtype: dtype to autocast to when running on CUDA, so convs and 
+            matmuls use Tensor Cores. When training, pair with a 
+            torch.cuda.amp.GradScaler.
 
     """
 
-    def __init__(self, N_a, B, K=4):
+    def __init__(self, N_a, B, K=4, amp_dtype=torch.float16):
         super().__init__()
         self.N_a = N_a
         self.B = B
         self.K = K        
+        self.amp_dtype = amp_dtype
         self.pose_rec = ActionCombined(True, N_a, K, B)
         self.appear_rec = ActionCombined(False, N_a, K, B)
         self.fc = nn.Linear(2 * N_a, N_a)
         self.log_softmax = nn.LogSoftmax(dim=1)
     
-    def forward(self, pose_input, entry_input, prob_maps):
+    def forward(self, pose_input, entry_input, prob_maps, return_logits=False):
         """
 
         Args:
@@ -228,19 +325,109 @@ class ActionRecognition(nn.Module):
                 the multitask stem based on Inception-V4.        
             prob_maps: B x N_J x H x W probability maps obtained at the 
                 end of pose estimation part (softmax applied to the xy heatmaps).   
+            return_logits: whether to also return the raw fc output, so 
+                training can use F.cross_entropy directly.
 
         Returns:
             B x N_a tensor with log probabilities for each action. 
                 Use exp to retrieve probabilities.
+
+            B x N_a tensor of raw logits, only if return_logits.
     
         """
 
-        appearance_input = appearance_extract(entry_input, prob_maps, self.B)
-        pose_actions, pose_out = self.pose_rec(pose_input)
-        appearance_actions, appearance_out = self.appear_rec(appearance_input)
-        # Isolate actions in last block B x 2 * N_a.        
-        fc_input = torch.cat((pose_actions, appearance_actions), dim=1) 
+        # Use NHWC so cuDNN dispatches its channels_last conv kernels. Only 
+        # the conv inputs are converted; entry_input and prob_maps just feed 
+        # a bmm.
+        pose_input = pose_input.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+                device_type='cuda', dtype=self.amp_dtype, 
+                enabled=pose_input.is_cuda):
+            appearance_input = appearance_extract(entry_input, prob_maps, self.B)
+            appearance_input = appearance_input.contiguous(
+                memory_format=torch.channels_last)
+            pose_actions, appearance_actions = self._recognize(
+                pose_input, appearance_input)
+            # Isolate actions in last block B x 2 * N_a.        
+            fc_input = torch.cat((pose_actions, appearance_actions), dim=1) 
+            fc_out = self.fc(fc_input)
         # Output of fc is B x N_a then log softmax N_a to get probabilities.
-        out = self.log_softmax(self.fc(fc_input))
+        # Done in fp32 for numerical stability.
+        logits = fc_out.float()
+        out = self.log_softmax(logits)
+        if return_logits:
+            return out, logits
         return out
+
+    def _recognize(self, pose_input, appearance_input):
+        """Runs the pose and appearance branches.
+
+        The branches share no data, so on CUDA the pose branch runs on a side 
+        stream while the appearance branch runs on the current one. The 
+        branches differ in input channels and widths, so they can't be merged 
+        into one grouped conv stack.
+
+        Returns:
+            B x N_a tensor with probabilities from the pose branch.
+
+            B x N_a tensor with probabilities from the appearance branch.
+
+        """
+
+        if not pose_input.is_cuda:
+            pose_actions, _ = self.pose_rec(pose_input)
+            appearance_actions, _ = self.appear_rec(appearance_input)
+            return pose_actions, appearance_actions
+        pose_stream = _pose_stream(pose_input.device)
+        current_stream = torch.cuda.current_stream(pose_input.device)
+        # The side stream must see the inputs written on the current stream.
+        pose_stream.wait_stream(current_stream)
+        with torch.cuda.stream(pose_stream):
+            pose_actions, _ = self.pose_rec(pose_input)
+        appearance_actions, _ = self.appear_rec(appearance_input)
+        current_stream.wait_stream(pose_stream)
+        # pose_actions was allocated on the side stream but is used from here.
+        pose_actions.record_stream(current_stream)
+        return pose_actions, appearance_actions
+
+    def compile_forward(self, mode='max-autotune'):
+        """Compiles forward with TorchInductor.
+
+        Opt-in rather than done in __init__, as compiling is slow and only 
+        pays off once the model is run many times. Call after 
+        fuse_for_inference if fusing, so the compiled graph sees the fused 
+        convs. Uses nn.Module.compile rather than replacing self.forward, 
+        so the module can still be pickled and deep-copied.
+
+        Args:
+            mode: torch.compile mode.
+
+        Returns:
+            self.
+
+        """
+
+        self.compile(mode=mode, dynamic=False)
+        return self
+
+    def fuse_for_inference(self):
+        """Folds batch normalization into the preceding conv of every ConvBlock.
+
+        Then merges the first convs of the pose ActionStart into one conv.
+        Puts the model in eval mode first, as fusing freezes the running 
+        statistics into the conv weights.
+
+        Returns:
+            self.
+
+        """
+
+        self.eval()
+        for module in list(self.modules()):
+            if isinstance(module, ConvBlock):
+                module.fuse_()
+        for module in list(self.modules()):
+            if isinstance(module, ActionStart):
+                module.fuse_()
+        return self
         
@@ -76,8 +76,8 @@ class PoseUpBlock(nn.Module):
         self.sc = SCBlock(576, 576, 5)
         self.conv1 = ConvBlock(576, N_d * N_J, 1)
         self.conv2 = ConvBlock(N_d * N_J, 576, 1)
-        self.softargmax_xy = SoftArgMax()
-        self.softargmax_z = SoftArgMax()
+        self.softargmax_xy = SoftArgMax(32, 32)
+        self.softargmax_z = SoftArgMax(N_d)
         self.batch_norm = nn.BatchNorm2d(576)
         self.relu = nn.ReLU()
     
@@ -147,7 +147,8 @@ class PoseEstimation(nn.Module):
         self.N_J = N_J
         self.B = B
         self.N_d = N_d
-        self.prediction_blocks = [PoseBlock(N_J, N_d) for i in range(K)]        
+        self.prediction_blocks = nn.ModuleList(
+            [PoseBlock(N_J, N_d) for _ in range(K)])
     
     def forward(self, x): 
         """